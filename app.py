@@ -3,22 +3,33 @@
 障害福祉サービス事業所向け - 受給者証・契約書の画像からデータを自動抽出
 """
 
-import base64
-import concurrent.futures
+import asyncio
+import hashlib
 import io
 import json
 import os
 import re
-import threading
 import time
-from collections import OrderedDict
 from pathlib import Path
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 
+# orjsonがあれば高速なJSONパースを使う（なければ標準ライブラリにフォールバック）
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# pybase64があればSIMD実装のbase64エンコードを使う（数MBの画像で効果が大きい）
+try:
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    from base64 import b64encode as _b64encode
+
 # app.pyと同じディレクトリの.envを明示的に読み込む（システム環境変数より優先）
 load_dotenv(Path(__file__).parent / ".env", override=True)
 
@@ -26,7 +37,8 @@ load_dotenv(Path(__file__).parent / ".env", override=True)
 # 定数
 # =============================================================================
 
-CSV_COLUMNS = [
+# タプルで固定（イミュータブル＆ホットループでの反復がリストよりわずかに速い）
+CSV_COLUMNS = (
     "事業",
     "利用者_姓",
     "利用者_名",
@@ -48,9 +60,9 @@ CSV_COLUMNS = [
     "住所",
     "電話番号",
     "メールアドレス",
-]
+)
 
-REQUIRED_FIELDS = [
+REQUIRED_FIELDS = (
     "事業",
     "利用者_姓",
     "利用者_名",
@@ -64,7 +76,12 @@ REQUIRED_FIELDS = [
     "支給決定満了日",
     "モニタリング_当初Nか月",
     "モニタリング_満了月からNか月ごと",
-]
+)
+
+# 信頼度計算用の事前計算テーブル（必須項目は重み2、任意項目は重み1）
+_REQUIRED_SET = frozenset(REQUIRED_FIELDS)
+_FIELD_WEIGHTS = tuple(2 if c in _REQUIRED_SET else 1 for c in CSV_COLUMNS)
+_TOTAL_WEIGHT = sum(_FIELD_WEIGHTS)
 
 EXTRACTION_PROMPT = """あなたは障害福祉サービスの書類読み取り専門のアシスタントです。
 
@@ -154,9 +171,11 @@ EXTRACTION_PROMPT = """あなたは障害福祉サービスの書類読み取り
 """
 
 MAX_FILES = 10
+MAX_UPLOAD_BYTES = 50_000_000  # 1ファイルの上限。これ以上は処理前に弾く
 MAX_IMAGE_BYTES = 4_500_000  # base64変換後に5MB以内に収まるよう余裕を持たせる
 # OCR用の最適画像設定（解像度を下げすぎると読み取り精度が落ちる）
 OCR_MAX_DIMENSION = 1600  # OCRに十分な最大辺ピクセル数
+OCR_MAX_PIXELS = 1_300_000  # Anthropic推奨の約1.3メガピクセル上限（超過分はAPI側で縮小される）
 OCR_JPEG_QUALITY = 80     # JPEG圧縮品質（OCRには80で十分）
 # プレビュー/レビュー用サムネイル設定
 PREVIEW_MAX_DIMENSION = 800   # プレビュー表示用（これで十分）
@@ -167,6 +186,28 @@ PREVIEW_JPEG_QUALITY = 60     # プレビュー品質
 # =============================================================================
 
 
+@st.cache_resource
+def _preload_heavy_modules() -> bool:
+    """重量級モジュールをセッション初期化時に一度だけ読み込んでおく
+
+    PILやSDKの初回importは数十msかかる。関数内のローカルimport自体は
+    維持しつつ（任意依存の扱いを変えないため）、初回コストを抽出ボタン
+    押下時ではなく起動時に前払いする。以降のローカルimportは
+    sys.modules の参照だけになる。
+    """
+    import importlib
+
+    importlib.import_module("PIL.Image")
+    importlib.import_module("anthropic")
+    for name in ("fitz", "pdf2image", "gspread", "openai"):
+        # 任意依存は無くても起動を妨げない（実際に使う箇所でエラー表示する）
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    return True
+
+
 def get_secret(key: str) -> str:
     """Streamlit Cloud の secrets → .env の順でキーを取得"""
     try:
@@ -180,50 +221,97 @@ def get_secret(key: str) -> str:
 # =============================================================================
 
 
-def compress_image(image_bytes: bytes, media_type: str) -> tuple[bytes, str]:
-    """画像をOCR最適サイズに常時圧縮する（API速度＋精度のバランス）
+def compress_image(image_bytes: bytes, media_type: str) -> tuple[str, str]:
+    """画像をOCR最適サイズに圧縮し、API送信用のbase64文字列を返す
 
     受給者証・契約書のOCRでは1600px・JPEG 80で十分な精度が得られる。
     元画像が小さい場合は拡大せずそのまま圧縮のみ行う。
     """
     from PIL import Image
 
-    img = Image.open(io.BytesIO(image_bytes))
+    img = Image.open(io.BytesIO(image_bytes))  # ヘッダーのみ読む（ピクセルデコードは遅延）
+    w, h = img.size
 
-    # OCR最適解像度にリサイズ（元画像が小さければ拡大しない）
-    if max(img.size) > OCR_MAX_DIMENSION:
-        img.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
+    # 既にバイト・ピクセルとも予算内のJPEGは、デコード・再エンコードせずそのまま使う
+    if (
+        media_type == "image/jpeg"
+        and img.format == "JPEG"
+        and len(image_bytes) <= MAX_IMAGE_BYTES
+        and w * h <= OCR_MAX_PIXELS
+    ):
+        return _b64encode(image_bytes).decode("ascii"), "image/jpeg"
 
-    rgb_img = img.convert("RGB") if img.mode != "RGB" else img
+    # 大きいJPEGはdraftでDCTドメインの粗い縮小を先に効かせる
+    # （フルデコード+thumbnailよりはるかに速い。最終サイズ調整は_compress_pilで行う）
+    if img.format == "JPEG" and w * h > OCR_MAX_PIXELS:
+        img.draft("RGB", (OCR_MAX_DIMENSION, OCR_MAX_DIMENSION))
 
-    # まずOCR品質で圧縮
-    buf = io.BytesIO()
-    rgb_img.save(buf, format="JPEG", quality=OCR_JPEG_QUALITY)
-    result = buf.getvalue()
-    if len(result) <= MAX_IMAGE_BYTES:
-        return result, "image/jpeg"
+    return _compress_pil(img)
 
-    # API上限を超える場合は段階的に品質を下げる
-    for quality in (60, 45, 30):
-        buf = io.BytesIO()
-        rgb_img.save(buf, format="JPEG", quality=quality)
-        result = buf.getvalue()
-        if len(result) <= MAX_IMAGE_BYTES:
-            return result, "image/jpeg"
 
-    # それでも超える場合はさらに縮小
-    img.thumbnail((1200, 1200), Image.LANCZOS)
-    buf = io.BytesIO()
-    img.convert("RGB").save(buf, format="JPEG", quality=30)
-    return buf.getvalue(), "image/jpeg"
+def _compress_pil(img) -> tuple[str, str]:
+    """デコード済みPIL画像をJPEG圧縮し、API送信用のbase64文字列を返す
 
+    PDF変換のようにPIL Imageが既に手元にある場合はここを直接呼ぶことで、
+    中間バイト列へのエンコード→再デコードを省ける。imgは破壊的に変更される。
+    base64はBytesIOの内部バッファ（getbuffer）から直接エンコードするため、
+    getvalueによる中間bytesのコピーが発生しない。
+    """
+    from PIL import Image
+
+    # OCR最適解像度にリサイズ（元画像が小さければ拡大しない）。
+    # バイト数だけでなく総ピクセル数も約1.3MPに抑える。これを超えると
+    # API側で縮小される＝送信バイトと画像トークンが無駄になるため。
+    w, h = img.size
+    if w * h > OCR_MAX_PIXELS:
+        scale = (OCR_MAX_PIXELS / (w * h)) ** 0.5
+        img.thumbnail((max(int(w * scale), 1), max(int(h * scale), 1)), Image.LANCZOS)
+    elif max(img.size) > OCR_MAX_DIMENSION:
+        img.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.LANCZOS)
 
-def make_thumbnail(image_bytes: bytes) -> bytes:
-    """レビュー画面用のサムネイルを生成（元画像より大幅に軽量化）"""
+    # RGB変換は一度だけ行い、品質ループ内ではバッファを使い回す
+    rgb_img = img.convert("RGB") if img.mode != "RGB" else img
+    buf = io.BytesIO()
+
+    # まずOCR品質で圧縮。文字情報は輝度成分に乗るため、4:2:0の
+    # クロマサブサンプリング（subsampling=2）で色差分を半減させても精度に影響しない
+    rgb_img.save(buf, format="JPEG", quality=OCR_JPEG_QUALITY, subsampling=2)
+    size = buf.tell()
+    if size <= MAX_IMAGE_BYTES:
+        return _b64encode(buf.getbuffer()).decode("ascii"), "image/jpeg"
+
+    # API上限超過時: 品質を段階的に試すのではなく、1回目のエンコード結果から
+    # 必要な品質を直接見積もる（書類スキャンではサイズは品質におおむね比例）。
+    # 再エンコードは最悪でも1回で済む。
+    ratio = MAX_IMAGE_BYTES / size * 0.9  # 安全率込み
+    quality = max(30, min(OCR_JPEG_QUALITY - 5, int(OCR_JPEG_QUALITY * ratio)))
+    buf.seek(0)
+    buf.truncate(0)
+    rgb_img.save(buf, format="JPEG", quality=quality, subsampling=2)
+    if buf.tell() <= MAX_IMAGE_BYTES:
+        return _b64encode(buf.getbuffer()).decode("ascii"), "image/jpeg"
+
+    # 見積もりが大きく外れた場合のみ縮小フォールバック（変換済みRGB画像をそのまま縮小）
+    rgb_img.thumbnail((1200, 1200), Image.LANCZOS)
+    buf.seek(0)
+    buf.truncate(0)
+    rgb_img.save(buf, format="JPEG", quality=30, subsampling=2)
+    return _b64encode(buf.getbuffer()).decode("ascii"), "image/jpeg"
+
+
+def make_thumbnail(image) -> bytes:
+    """レビュー画面用のサムネイルを生成（元画像より大幅に軽量化）
+
+    バイト列とデコード済みPIL Imageのどちらも受け付ける。Imageを渡す場合は
+    コピーしてから縮小するので呼び出し元の画像は変更されない。
+    """
     from PIL import Image
 
     try:
-        img = Image.open(io.BytesIO(image_bytes))
+        if isinstance(image, Image.Image):
+            img = image.copy()  # thumbnailは破壊的
+        else:
+            img = Image.open(io.BytesIO(image))
         if max(img.size) > PREVIEW_MAX_DIMENSION:
             img.thumbnail((PREVIEW_MAX_DIMENSION, PREVIEW_MAX_DIMENSION), Image.LANCZOS)
         rgb_img = img.convert("RGB") if img.mode != "RGB" else img
@@ -231,30 +319,121 @@ def make_thumbnail(image_bytes: bytes) -> bytes:
         rgb_img.save(buf, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
         return buf.getvalue()
     except Exception:
-        return image_bytes  # 変換失敗時は元画像をそのまま返す
+        return image if isinstance(image, bytes) else b""  # 変換失敗時は元画像をそのまま返す
 
 
-def convert_pdf_to_image(pdf_bytes: bytes) -> Optional[bytes]:
-    """PDFの1ページ目を画像に変換"""
+# 重複判定の閾値。このアプリの典型バッチは「同一帳票テンプレートに別人の
+# データが入った受給者証がN枚」なので、粗いハッシュだと罫線・枠だけで
+# 別人同士が衝突し得る。16x16（256bit）のdHashを小さい距離で照合し、
+# さらに縮小画素の平均差でも確認して、再スキャン程度の差だけを同一とみなす。
+_DHASH_SIZE = 16
+_DHASH_MAX_DISTANCE = 8  # 256bit中のハミング距離上限
+_DUP_GRAY_SIZE = 32
+_DUP_MAX_PIXEL_DIFF = 6.0  # 32x32グレースケールの平均画素差の上限（0-255）
+
+
+def _image_fingerprint(img) -> tuple[int, bytes]:
+    """重複検出用の指紋 (dHash, 縮小グレースケール画素) を計算する
+
+    同一書類の重複アップロード（2回スキャン等）検出用。グレースケール縮小と
+    隣接ピクセルの明暗差の畳み込みだけなので外部依存なしで計算できる。
+    """
+    from PIL import Image
+
+    gray = img.convert("L")
+    small = gray.resize((_DHASH_SIZE + 1, _DHASH_SIZE), Image.BILINEAR)
+    px = small.load()
+    bits = 0
+    for y in range(_DHASH_SIZE):
+        for x in range(_DHASH_SIZE):
+            bits = (bits << 1) | (px[x, y] > px[x + 1, y])
+    pixels = bytes(gray.resize((_DUP_GRAY_SIZE, _DUP_GRAY_SIZE), Image.BILINEAR).getdata())
+    return bits, pixels
+
+
+def _fingerprint_of_bytes(image_bytes: bytes) -> Optional[tuple[int, bytes]]:
+    """画像バイト列から重複検出用の指紋を計算する（失敗時None）
+
+    draftで1/8スケールの粗いデコードを要求するため、フルデコードに比べ
+    大きなJPEGでも数ms程度で済む。
+    """
+    from PIL import Image
+
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft("L", (128, 128))
+        return _image_fingerprint(img)
+    except Exception:
+        return None
+
+
+def _same_document(fp_a: tuple[int, bytes], fp_b: tuple[int, bytes]) -> bool:
+    """2つの指紋が同一書類（再スキャン程度の差）かを判定する
+
+    dHashの距離照合を通っても、縮小画素の平均差で裏取りしてから同一と
+    みなす。別人の書類を誤って同一扱いすると個人データの取り違えになる
+    ため、閾値は取りこぼし側に倒してある。
+    """
+    if (fp_a[0] ^ fp_b[0]).bit_count() > _DHASH_MAX_DISTANCE:
+        return False
+    diff = sum(abs(a - b) for a, b in zip(fp_a[1], fp_b[1]))
+    return diff / len(fp_a[1]) <= _DUP_MAX_PIXEL_DIFF
+
+
+PDF_RENDER_DPI = 150  # A4で約2MP。OCRに十分で、200dpi+PNGよりレンダリングが大幅に軽い
+
+
+def _render_pdf_with_fitz(pdf_bytes: bytes):
+    """PyMuPDFで1ページ目をインプロセスレンダリングする（未インストールならNone）
+
+    Popplerのサブプロセス起動と一時ファイル往復が無い分pdf2imageより大幅に速い。
+    """
     try:
+        import fitz
+    except ImportError:
+        return None
+
+    from PIL import Image
+
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pix = doc.load_page(0).get_pixmap(dpi=PDF_RENDER_DPI)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def convert_pdf_to_image(pdf_bytes: bytes) -> tuple[object, Optional[str]]:
+    """PDFの1ページ目をレンダリングして (PIL Image, エラーメッセージ) を返す
+
+    バイト列ではなくデコード済みImageを返すことで、呼び出し側は中間
+    エンコード→再デコードなしにそのまま圧縮・サムネイル生成に使える。
+    PyMuPDFがあればそちらを優先し、無ければpdf2image(Poppler)に切り替える。
+
+    ワーカースレッドから呼ばれるためここではst.*を使わない（スレッドからの
+    st呼び出しはScriptRunContextがなく無言で捨てられる）。失敗時は
+    (None, 理由文字列) を返し、表示はメインスレッド側に任せる。
+    """
+    try:
+        image = _render_pdf_with_fitz(pdf_bytes)
+        if image is not None:
+            return image, None
+
         from pdf2image import convert_from_bytes
 
-        images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, dpi=200)
+        images = convert_from_bytes(
+            pdf_bytes, first_page=1, last_page=1, dpi=PDF_RENDER_DPI, fmt="jpeg",
+        )
         if images:
-            buf = io.BytesIO()
-            images[0].save(buf, format="PNG")
-            return buf.getvalue()
+            return images[0], None
+        return None, "PDF変換エラー: ページをレンダリングできませんでした"
     except ImportError:
-        st.error(
-            "pdf2imageがインストールされていません。"
-            "また、Popplerのインストールも必要です。\n"
+        return None, (
+            "PyMuPDFまたはpdf2imageのインストールが必要です。\n"
+            "pdf2imageを使う場合はPopplerも必要です。\n"
             "Windows: https://github.com/oschwartz10612/poppler-windows/releases\n"
             "Mac: `brew install poppler`\n"
             "Linux: `sudo apt-get install poppler-utils`"
         )
     except Exception as e:
-        st.error(f"PDF変換エラー: {e}")
-    return None
+        return None, f"PDF変換エラー: {e}"
 
 
 def get_media_type(filename: str) -> str:
@@ -267,57 +446,157 @@ def get_media_type(filename: str) -> str:
 # AI 抽出
 # =============================================================================
 
+ANTHROPIC_MODEL = "claude-sonnet-4-20250514"
+
+# 同一画像の再抽出でAPIを呼び直さないためのディスクキャッシュ。
+# キーは圧縮済み画像の内容＋モデル名＋プロンプトのハッシュなので、
+# プロンプトやモデルを変更すれば自動的にキャッシュミスになる。
+_EXTRACTION_CACHE_DIR = Path.home() / ".cache" / "data_app" / "extractions"
+_PROMPT_HASH = hashlib.sha256(EXTRACTION_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+# プロンプト部分のcontentブロックはモジュールロード時に1回だけ組み立てて使い回す。
+# 全リクエストでバイト単位に同一のプレフィックスになるため、cache_controlによる
+# プロンプトキャッシュのハッシュ一致も保証される（書き換え禁止）。
+_ANTHROPIC_TEXT_BLOCK = {
+    "type": "text",
+    "text": EXTRACTION_PROMPT,
+    "cache_control": {"type": "ephemeral"},
+}
 
-def parse_json_response(text: str) -> Optional[dict]:
-    """APIレスポンスからJSONを抽出・パース"""
+
+def _extraction_cache_path(image_base64: str) -> Path:
+    image_hash = hashlib.sha256(image_base64.encode("ascii")).hexdigest()
+    return _EXTRACTION_CACHE_DIR / f"{image_hash}-{ANTHROPIC_MODEL}-{_PROMPT_HASH}.json"
+
+
+def _load_cached_extraction(path: Path) -> Optional[dict]:
+    """キャッシュされた抽出結果を読む（なければ・壊れていればNone）"""
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _store_cached_extraction(path: Path, result: dict):
+    """抽出結果をキャッシュに保存（書き込み失敗は無視してよい）"""
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+    except OSError:
         pass
 
-    if "```" in text:
-        start = text.find("```")
-        end = text.rfind("```")
-        if start != end:
-            json_block = text[start:end]
-            first_newline = json_block.find("\n")
-            if first_newline != -1:
-                json_block = json_block[first_newline + 1:]
-            try:
-                return json.loads(json_block.strip())
-            except json.JSONDecodeError:
-                pass
-
-    start = text.find("{")
-    end = text.rfind("}")
-    if start != -1 and end > start:
+
+@st.cache_resource
+def _get_openai_client():
+    """OpenAIクライアントを生成してセッション間で共有する
+
+    Anthropic側は非同期クライアントを抽出実行ごとに作り直すため（イベント
+    ループに束縛される）、cache_resourceで持つのはこちらだけ。
+    """
+    from openai import OpenAI
+
+    return OpenAI(api_key=get_secret("OPENAI_API_KEY"))
+
+
+# コードフェンス内のJSON / 最初の{から最後の}までを1回の走査で切り出す
+_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*\})\s*```", re.DOTALL)
+_BRACE_RE = re.compile(r"\{.*\}", re.DOTALL)
+# よくある軽微な構文崩れの修復用: 末尾カンマと、Pythonリテラル風のTrue/False/None
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_PY_LITERAL_RE = re.compile(r"\b(True|False|None)\b")
+_PY_LITERAL_MAP = {"True": "true", "False": "false", "None": "null"}
+
+
+def _repair_json_candidate(candidate: str) -> Optional[dict]:
+    """壊れかけのJSON文字列を軽微な修復を試みてからパースする
+
+    モデル出力に時々混ざる末尾カンマ・Pythonリテラルだけを対象にした
+    保守的な修復。直らなければNoneを返し、呼び出し側のエラー表示に任せる。
+    """
+    repaired = _TRAILING_COMMA_RE.sub(r"\1", candidate)
+    repaired = _PY_LITERAL_RE.sub(lambda m: _PY_LITERAL_MAP[m.group(1)], repaired)
+    if repaired == candidate:
+        return None  # 修復箇所がなければ再パースも失敗する
+    try:
+        return _json_loads(repaired)
+    except ValueError:
+        return None
+
+
+@st.cache_data(show_spinner=False)
+def _parse_json_text(text: str) -> Optional[dict]:
+    """レスポンステキストからJSONを抽出・パースする純粋関数部分
+
+    st.rerun のたびに同じレスポンスを再パースしないよう、テキストをキーに
+    st.cache_data でキャッシュする（UI表示は parse_json_response 側で行う）。
+    """
+    # orjson.JSONDecodeErrorも標準のJSONDecodeErrorもValueErrorの派生
+    try:
+        return _json_loads(text)
+    except ValueError:
+        pass
+
+    m = _FENCE_RE.search(text)
+    if m:
         try:
-            return json.loads(text[start:end + 1])
-        except json.JSONDecodeError:
+            return _json_loads(m.group(1))
+        except ValueError:
             pass
 
-    st.error("AIからのレスポンスをJSON形式で解析できませんでした。")
-    st.code(text, language="text")
+    m = _BRACE_RE.search(text)
+    if m:
+        candidate = m.group(0)
+        try:
+            return _json_loads(candidate)
+        except ValueError:
+            pass
+        # 最後に軽微な構文崩れの修復を試す（末尾カンマ・Pythonリテラル）。
+        # 失敗レスポンスの再取得はAPI課金・数秒の待ちがかかるため、
+        # 直せるものは手元で救う。
+        return _repair_json_candidate(candidate)
+
     return None
 
 
+def parse_json_response(text: str) -> Optional[dict]:
+    """APIレスポンスからJSONを抽出・パース"""
+    result = _parse_json_text(text)
+    if result is None:
+        st.error("AIからのレスポンスをJSON形式で解析できませんでした。")
+        st.code(text, language="text")
+    return result
+
+
+_WAREKI_RE = re.compile(r"(令和|平成|昭和)\s*(\d+)\s*年\s*(\d+)\s*月\s*(\d+)\s*日")
+_ERA_BASE_YEAR = {"令和": 2018, "平成": 1988, "昭和": 1925}
+
+
 def _convert_wareki_to_seireki(text: str) -> str:
     """和暦（令和/平成/昭和）をYYYY年MM月DD日形式に変換"""
-    era_map = {"令和": 2018, "平成": 1988, "昭和": 1925}
-    m = re.match(r"(令和|平成|昭和)\s*(\d+)\s*年\s*(\d+)\s*月\s*(\d+)\s*日", text.strip())
+    m = _WAREKI_RE.match(text.strip())
     if m:
         era, y, month, day = m.group(1), int(m.group(2)), int(m.group(3)), int(m.group(4))
-        year = era_map[era] + y
+        year = _ERA_BASE_YEAR[era] + y
         return f"{year}年{month:02d}月{day:02d}日"
     return text
 
 
+@st.cache_data(show_spinner=False)
 def _postprocess_extraction(result: dict) -> dict:
-    """抽出結果の後処理（郵便番号ハイフン除去、和暦変換など）"""
-    # 郵便番号ハイフン除去
-    postal = str(result.get("郵便番号", ""))
+    """抽出結果の後処理（スキーマ正規化、郵便番号ハイフン除去、和暦変換など）"""
+    result = dict(result)  # キャッシュキーになる引数を変更しないようコピーする
+
+    # スキーマを固定化: CSV出力対象カラムをすべてstrip済みのstrで揃える。
+    # モデル出力のキー欠損やnull・数値をここで吸収するので、以降の処理は
+    # 型チェックなしでdict参照できる。
+    for col in CSV_COLUMNS:
+        val = result.get(col)
+        result[col] = str(val).strip() if val is not None else ""
+
+    # 郵便番号ハイフン除去（数字だけ残す。短い文字列には正規表現よりCレベルのfilterが速い）
+    postal = result["郵便番号"]
     if postal:
-        result["郵便番号"] = re.sub(r"[^\d]", "", postal)
+        result["郵便番号"] = "".join(filter(str.isdigit, postal))
 
     # 日付フィールドの和暦→西暦変換
     for date_field in ["契約日", "支給決定開始日", "支給決定満了日", "生年月日"]:
@@ -328,30 +607,36 @@ def _postprocess_extraction(result: dict) -> dict:
     return result
 
 
-def extract_with_anthropic(image_base64: str, media_type: str) -> Optional[dict]:
-    """Anthropic Claude Vision APIで画像からデータを抽出"""
-    try:
-        import anthropic
+async def extract_with_anthropic(client, image_base64: str, media_type: str) -> Optional[dict]:
+    """Anthropic Claude Vision APIで画像からデータを抽出（非同期）
 
-        api_key = get_secret("ANTHROPIC_API_KEY")
-        if not api_key or api_key.startswith("sk-ant-xxx"):
-            st.error("ANTHROPIC_API_KEYが設定されていません。.envファイルまたはStreamlit Secretsを確認してください。")
-            return None
+    同一画像はディスクキャッシュから即座に返す（API課金・待ち時間ゼロ）。
+    """
+    cache_path = _extraction_cache_path(image_base64)
+    cached = _load_cached_extraction(cache_path)
+    if cached is not None:
+        return cached
 
-        client = anthropic.Anthropic(api_key=api_key)
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
+    try:
+        message = await client.messages.create(
+            model=ANTHROPIC_MODEL,
             max_tokens=2048,
             messages=[{
                 "role": "user",
                 "content": [
+                    # 固定プロンプトを先頭に置きcache_controlを付けることで、
+                    # 2枚目以降はプロンプト分の入力トークンがキャッシュヒットになる
+                    # （プレフィックスのみキャッシュ対象のため画像より前に置く）
+                    _ANTHROPIC_TEXT_BLOCK,
                     {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_base64}},
-                    {"type": "text", "text": EXTRACTION_PROMPT},
                 ],
             }],
         )
         result = parse_json_response(message.content[0].text)
-        return _postprocess_extraction(result) if result else None
+        result = _postprocess_extraction(result) if result else None
+        if result is not None:
+            _store_cached_extraction(cache_path, result)
+        return result
     except Exception as e:
         st.error(f"Anthropic API エラー: {e}")
         return None
@@ -360,14 +645,12 @@ def extract_with_anthropic(image_base64: str, media_type: str) -> Optional[dict]
 def extract_with_openai(image_base64: str, media_type: str) -> Optional[dict]:
     """OpenAI GPT-4 Vision APIで画像からデータを抽出"""
     try:
-        from openai import OpenAI
-
         api_key = get_secret("OPENAI_API_KEY")
         if not api_key or api_key.startswith("sk-xxx"):
             st.error("OPENAI_API_KEYが設定されていません。.envファイルまたはStreamlit Secretsを確認してください。")
             return None
 
-        client = OpenAI(api_key=api_key)
+        client = _get_openai_client()
         response = client.chat.completions.create(
             model="gpt-4o",
             max_tokens=2048,
@@ -391,30 +674,38 @@ def extract_with_openai(image_base64: str, media_type: str) -> Optional[dict]:
 # =============================================================================
 
 
+@st.cache_data(show_spinner=False, max_entries=256)
 def calc_confidence(data: dict) -> tuple[int, str, list[str]]:
-    """レコードの照合率(%)・判定ラベル・要確認項目リストを返す"""
+    """レコードの照合率(%)・判定ラベル・要確認項目リストを返す
+
+    ウィジェット操作のたびに全レコード分再計算されるため、レコード内容を
+    キーにst.cache_dataでキャッシュする（内容が変われば自動で再計算）。
+
+    重みは事前計算済みの _FIELD_WEIGHTS を使い、必須項目の問題有無も
+    同じループ内で判定する（低信頼リストを再走査しない）。
+    """
     confidence_map = data.get("confidence", {})
-    total_weight = 0
     earned = 0.0
     low_fields = []
+    required_low = False
 
-    for col in CSV_COLUMNS:
-        weight = 2 if col in REQUIRED_FIELDS else 1
-        total_weight += weight
+    for col, weight in zip(CSV_COLUMNS, _FIELD_WEIGHTS):
         val = str(data.get(col, "")).strip()
         ai_conf = confidence_map.get(col, "high" if val else "low")
 
         if not val:
             low_fields.append(col)
+            required_low = required_low or weight == 2
         elif ai_conf == "low":
             earned += weight * 0.5
             low_fields.append(col)
+            required_low = required_low or weight == 2
         else:
             earned += weight
 
-    pct = int(earned / total_weight * 100) if total_weight else 0
+    pct = int(earned / _TOTAL_WEIGHT * 100)
 
-    if pct >= 90 and not any(col in low_fields for col in REQUIRED_FIELDS):
+    if pct >= 90 and not required_low:
         label = "OK"
     elif pct >= 60:
         label = "要確認"
@@ -426,38 +717,50 @@ def calc_confidence(data: dict) -> tuple[int, str, list[str]]:
 
 def is_record_ok(pct: int, low_fields: list[str]) -> bool:
     """照合率90%以上かつ必須項目に問題なしならTrue"""
-    return pct >= 90 and not any(col in low_fields for col in REQUIRED_FIELDS)
+    return pct >= 90 and _REQUIRED_SET.isdisjoint(low_fields)
+
 
+def _normalize_fields(data: dict) -> dict[str, str]:
+    """CSV出力対象カラムをstr化・strip済みの値だけのdictに正規化する
 
-def _match_key(row: dict) -> Optional[str]:
-    """突合キーを生成。受給者証番号優先、なければ姓名+生年月日"""
-    cert = str(row.get("受給者証番号", "")).strip()
+    突合キー生成とマージ比較が同じ値を何度もstr().strip()し直さないよう、
+    レコードごとに1回だけ正規化する。
+    """
+    return {col: str(data.get(col, "")).strip() for col in CSV_COLUMNS}
+
+
+def _match_key(norm: dict) -> Optional[str]:
+    """正規化済み値から突合キーを生成。受給者証番号優先、なければ姓名+生年月日"""
+    cert = norm["受給者証番号"]
     if cert:
         return f"cert:{cert}"
-    sei = str(row.get("利用者_姓", "")).strip()
-    mei = str(row.get("利用者_名", "")).strip()
-    birth = str(row.get("生年月日", "")).strip()
+    sei = norm["利用者_姓"]
+    mei = norm["利用者_名"]
+    birth = norm["生年月日"]
     if sei and mei and birth:
         return f"name:{sei}|{mei}|{birth}"
     return None
 
 
-def _name_key(row: dict) -> Optional[str]:
+def _name_key(norm: dict) -> Optional[str]:
     """姓名のみの突合キー（利用契約書など生年月日がないケース用）"""
-    sei = str(row.get("利用者_姓", "")).strip()
-    mei = str(row.get("利用者_名", "")).strip()
+    sei = norm["利用者_姓"]
+    mei = norm["利用者_名"]
     if sei and mei:
         return f"{sei}|{mei}"
     return None
 
 
-def _merge_into(existing: dict, data: dict):
-    """既存レコードに新しいデータをマージ（空欄埋め・high優先）"""
+def _merge_into(existing: dict, data: dict, norm: dict):
+    """既存レコードに新しいデータをマージ（空欄埋め・high優先）
+
+    existingのカラム値は正規化済み前提（グループ作成時にnormから構築される）。
+    """
     existing_conf = existing.get("confidence", {})
     new_conf = data.get("confidence", {})
     for col in CSV_COLUMNS:
-        new_val = str(data.get(col, "")).strip()
-        old_val = str(existing.get(col, "")).strip()
+        new_val = norm[col]
+        old_val = existing[col]
         new_c = new_conf.get(col, "low")
         old_c = existing_conf.get(col, "low")
         if not old_val and new_val:
@@ -483,24 +786,25 @@ def merge_records(data_list: list[dict]) -> list[dict]:
     1. _match_key（受給者証番号 or 姓名+生年月日）でマッチ
     2. マッチしなかった分を _name_key（姓名のみ）で既存グループに追加マッチ
     """
-    groups: OrderedDict[str, dict] = OrderedDict()
-    unmatched = []
+    groups: dict[str, dict] = {}
+    unmatched: list[tuple[dict, dict]] = []  # (元データ, 正規化済み値)
 
     # 第1段階: 受給者証番号 or 姓名+生年月日
     for data in data_list:
-        key = _match_key(data)
+        norm = _normalize_fields(data)
+        key = _match_key(norm)
         if key is None:
-            unmatched.append(data)
+            unmatched.append((data, norm))
             continue
 
         if key not in groups:
-            merged = {col: data.get(col, "") for col in CSV_COLUMNS}
+            merged = dict(norm)
             merged["confidence"] = dict(data.get("confidence", {}))
             merged["_source_files"] = [data.get("_source_file", "")]
             merged["_source_types"] = [data.get("_doc_type", "不明")]
             groups[key] = merged
         else:
-            _merge_into(groups[key], data)
+            _merge_into(groups[key], data, norm)
 
     # 第2段階: 姓名のみでマッチ（利用契約書など生年月日がないケース）
     # 既存グループの姓名キー → グループキーの逆引き辞書を構築
@@ -511,34 +815,53 @@ def merge_records(data_list: list[dict]) -> list[dict]:
             name_to_group[nk] = gkey
 
     still_unmatched = []
-    for data in unmatched:
-        nk = _name_key(data)
+    for data, norm in unmatched:
+        nk = _name_key(norm)
         if nk and nk in name_to_group:
-            _merge_into(groups[name_to_group[nk]], data)
+            _merge_into(groups[name_to_group[nk]], data, norm)
         else:
             still_unmatched.append(data)
 
     return list(groups.values()) + still_unmatched
 
 
+@st.cache_data(show_spinner=False, max_entries=8)
 def build_dataframe(data_list: list[dict]) -> tuple[pd.DataFrame, list[dict]]:
-    """抽出データのリストからDataFrame+信頼度情報を構築"""
-    rows = []
+    """抽出データのリストからDataFrame+信頼度情報を構築
+
+    st.cache_dataにより、データが変わらない再実行（チェックボックス操作等）
+    では前回のDataFrameを使い回す。
+
+    行dictのリストではなく列ごとのリストを組み立てて一括でDataFrame化する
+    （pandasは行指向の構築より列指向の方がはるかに速い）。
+    """
     confidence_info = []
+    labels = []
+    pcts = []
     for data in data_list:
         pct, label, low_fields = calc_confidence(data)
-        row = {"判定": label, "照合率": f"{pct}%"}
-        for col in CSV_COLUMNS:
-            row[col] = data.get(col, "")
-        rows.append(row)
+        labels.append(label)
+        pcts.append(f"{pct}%")
         confidence_info.append({"pct": pct, "label": label, "low_fields": low_fields})
-    display_cols = ["判定", "照合率"] + CSV_COLUMNS
-    return pd.DataFrame(rows, columns=display_cols), confidence_info
+
+    columns = {"判定": labels, "照合率": pcts}
+    for col in CSV_COLUMNS:
+        columns[col] = [data.get(col, "") for data in data_list]
+    return pd.DataFrame(columns), confidence_info
 
 
+@st.cache_data(show_spinner=False, max_entries=8)
 def to_csv_bytes(df: pd.DataFrame) -> bytes:
-    """DataFrameをUTF-8 BOM付きCSVバイト列に変換"""
-    return df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
+    """DataFrameをUTF-8 BOM付きCSVバイト列に変換
+
+    download_buttonのdata引数として再実行のたびに呼ばれるため、
+    DataFrameが変わらない限り前回のエンコード結果を使い回す。
+    バイナリバッファへ直接書き出すことで、str経由の再エンコードを省く。
+    """
+    buf = io.BytesIO()
+    buf.write(b"\xef\xbb\xbf")  # UTF-8 BOM（Excelでの文字化け防止）
+    df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
 
 
 # =============================================================================
@@ -546,8 +869,9 @@ def to_csv_bytes(df: pd.DataFrame) -> bytes:
 # =============================================================================
 
 
-def append_to_google_sheet(df: pd.DataFrame, spreadsheet_url: str, sheet_name: str) -> int:
-    """Google スプレッドシートの末尾にデータを追記し、追記した行数を返す"""
+@st.cache_resource(show_spinner=False)
+def _get_gspread_client():
+    """サービスアカウントの認証クライアントを生成する（セッション間で再利用）"""
     import gspread
 
     creds_path = Path(__file__).parent / "credentials.json"
@@ -557,16 +881,32 @@ def append_to_google_sheet(df: pd.DataFrame, spreadsheet_url: str, sheet_name: s
             "Google Cloud のサービスアカウントキーをダウンロードして "
             f"{creds_path} に配置してください。"
         )
+    return gspread.service_account(filename=str(creds_path))
+
 
-    gc = gspread.service_account(filename=str(creds_path))
-    sh = gc.open_by_url(spreadsheet_url)
-    worksheet = sh.worksheet(sheet_name)
+@st.cache_resource(show_spinner=False)
+def _get_worksheet(spreadsheet_url: str, sheet_name: str):
+    """スプレッドシートを開いてワークシートを取得する（URL・シート名ごとにキャッシュ）"""
+    sh = _get_gspread_client().open_by_url(spreadsheet_url)
+    return sh.worksheet(sheet_name)
 
-    if not worksheet.get_all_values():
-        worksheet.append_row(CSV_COLUMNS, value_input_option="USER_ENTERED")
 
-    rows = df.fillna("").astype(str).values.tolist()
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+def append_to_google_sheet(df: pd.DataFrame, spreadsheet_url: str, sheet_name: str) -> int:
+    """Google スプレッドシートの末尾にデータを追記し、追記した行数を返す"""
+    # 認証・open_by_url・worksheet 解決はそれぞれネットワーク往復を伴うため
+    # cache_resource で保持し、クリックごとの通信はappend本体だけにする
+    worksheet = _get_worksheet(spreadsheet_url, sheet_name)
+
+    # 列単位でキャストしてから行に転置する（fillna+astypeで中間DataFrameを
+    # 丸ごと作るより、列ごとの処理の方がセル数分のオブジェクト生成を抑えられる）
+    cols = [df[c].fillna("").astype(str).to_list() for c in df.columns]
+    rows = [list(r) for r in zip(*cols)]
+
+    # 空シート判定はA1セルだけ読めば十分（get_all_valuesはシート全体を転送してしまう）。
+    # ヘッダーが必要な場合もデータと一緒に1回のappendリクエストで追記する。
+    need_header = not worksheet.acell("A1").value
+    payload = [list(CSV_COLUMNS)] + rows if need_header else rows
+    worksheet.append_rows(payload, value_input_option="USER_ENTERED")
     return len(rows)
 
 
@@ -623,6 +963,9 @@ def render_upload_section() -> list:
         label_visibility="collapsed",
     )
 
+    # アップローダーから外れたファイルの生バイト・サムネイルを捨てる
+    _prune_file_caches(uploaded_files or [])
+
     if not uploaded_files:
         st.info("ファイルをドラッグ&ドロップ、またはクリックしてアップロードしてください。")
         return []
@@ -631,6 +974,15 @@ def render_upload_section() -> list:
         st.error(f"アップロードは{MAX_FILES}枚までです。現在{len(uploaded_files)}枚選択されています。")
         return []
 
+    # 異常に大きいファイルはメモリに読み込む前に弾く
+    too_large = [uf.name for uf in uploaded_files if uf.size > MAX_UPLOAD_BYTES]
+    if too_large:
+        st.error(
+            f"ファイルサイズが大きすぎます（上限{MAX_UPLOAD_BYTES // 1_000_000}MB）: "
+            + ", ".join(too_large)
+        )
+        return []
+
     return uploaded_files
 
 
@@ -639,6 +991,41 @@ def render_upload_section() -> list:
 # =============================================================================
 
 
+def _file_cache_key(uf) -> str:
+    """session_state内のファイル単位キャッシュで使う共通キー"""
+    return getattr(uf, "file_id", None) or f"{uf.name}:{uf.size}"
+
+
+def _prune_file_caches(uploaded_files: list):
+    """現在のアップロード一覧にないファイルのキャッシュを落とす
+
+    file_bytesは1ファイル最大50MBの生バイトを保持するため、ファイルを
+    差し替えながら使う長いセッションで無制限に溜まらないよう、アップローダー
+    から消えたファイルのエントリをここで破棄する。
+    """
+    current = {_file_cache_key(uf) for uf in uploaded_files}
+    for cache_name in ("file_bytes", "preview_thumbs"):
+        cache = st.session_state.get(cache_name)
+        if cache:
+            for key in [k for k in cache if k not in current]:
+                del cache[key]
+
+
+def _get_preview_thumbnail(uf) -> bytes:
+    """プレビュー用サムネイルをsession_stateにキャッシュして返す
+
+    再実行のたびに数MBのスキャン画像を再送せず、軽量サムネイルだけを
+    フロントエンドに渡す。
+    """
+    cache = st.session_state.setdefault("preview_thumbs", {})
+    key = _file_cache_key(uf)
+    thumb = cache.get(key)
+    if thumb is None:
+        thumb = make_thumbnail(_get_file_bytes(uf))
+        cache[key] = thumb
+    return thumb
+
+
 def render_file_list(uploaded_files: list):
     """アップロード済みファイルの一覧とプレビューを描画"""
     n = len(uploaded_files)
@@ -653,7 +1040,10 @@ def render_file_list(uploaded_files: list):
         cols = st.columns(3)
         for i, uf in enumerate(uploaded_files):
             with cols[i % 3]:
-                st.image(uf, caption=uf.name, use_container_width=True)
+                # フル解像度を毎回フロントに送り直さないよう、サムネイルを
+                # 一度だけ生成してsession_stateから使い回す（PDFは対象外）
+                preview = uf if uf.name.lower().endswith(".pdf") else _get_preview_thumbnail(uf)
+                st.image(preview, caption=uf.name, use_container_width=True)
 
 
 # =============================================================================
@@ -661,50 +1051,145 @@ def render_file_list(uploaded_files: list):
 # =============================================================================
 
 
-def _prepare_file(uf) -> tuple[str, bytes, Optional[str], Optional[str]]:
-    """ファイルを読み込み・圧縮してAPI呼び出し用データを準備する（メインスレッドで実行）
+def _get_file_bytes(uf) -> bytes:
+    """アップロードファイルの生バイトをsession_stateにキャッシュして返す
 
-    Returns: (fname, thumbnail_bytes, image_base64, media_type)
-        image_base64がNoneの場合は準備失敗
-        thumbnail_bytesはレビュー表示用の軽量画像
+    抽出をやり直した場合などの再実行時に、アップローダーのバッファから
+    同じファイルを読み直さないようにする。
+    """
+    cache = st.session_state.setdefault("file_bytes", {})
+    key = _file_cache_key(uf)
+    data = cache.get(key)
+    if data is None:
+        data = uf.getvalue()
+        cache[key] = data
+    return data
+
+
+def _prepare_file(fname: str, file_bytes: bytes):
+    """ファイルを圧縮してAPI呼び出し用データを準備する（ワーカースレッドで実行）
+
+    スレッド内からのst.*呼び出しは表示されないため、失敗理由はerror文字列で
+    返してメインスレッド側で表示する。
+
+    Returns: (fname, thumb_src, image_base64, media_type, fingerprint, error)
+        image_base64がNoneの場合は準備失敗（errorに理由が入る）
+        thumb_srcはサムネイル生成用の素材（bytesまたはPIL Image）。
+        サムネイル生成自体はAPI待ちと並行して行えるよう呼び出し側に委ねる。
+        fingerprintは重複検出用の指紋（計算失敗時None）。
     """
-    file_bytes = uf.read()
-    fname = uf.name
-
     if fname.lower().endswith(".pdf"):
-        image_bytes = convert_pdf_to_image(file_bytes)
-        if image_bytes is None:
-            st.warning(f"PDF変換失敗: {fname}")
-            return fname, file_bytes, None, None
-        mtype = "image/png"
+        pil_img, pdf_error = convert_pdf_to_image(file_bytes)
+        if pil_img is None:
+            return fname, file_bytes, None, None, None, pdf_error
+        image_base64, comp_mtype = _compress_pil(pil_img)
+        # 圧縮でOCRサイズに縮小済みの画像はそのままサムネイル素材として十分
+        thumb_src = pil_img
+        fingerprint = _image_fingerprint(pil_img)
     else:
-        image_bytes = file_bytes
-        mtype = get_media_type(fname)
+        image_base64, comp_mtype = compress_image(file_bytes, get_media_type(fname))
+        thumb_src = file_bytes
+        fingerprint = _fingerprint_of_bytes(file_bytes)
 
-    # OCR用に圧縮（API送信用）
-    compressed, comp_mtype = compress_image(image_bytes, mtype)
-    image_base64 = base64.b64encode(compressed).decode("utf-8")
-    # レビュー表示用のサムネイル生成（さらに軽量）
-    thumbnail = make_thumbnail(image_bytes)
-    return fname, thumbnail, image_base64, comp_mtype
+    return fname, thumb_src, image_base64, comp_mtype, fingerprint, None
 
 
-def _call_api(fname: str, image_base64: str, media_type: str) -> tuple[str, Optional[dict]]:
-    """API呼び出しのみ（ワーカースレッドで実行）"""
-    extracted = extract_with_anthropic(image_base64, media_type)
-    return fname, extracted
+MAX_PARALLEL = 3  # 並列API呼び出し数
 
 
-MAX_PARALLEL = 3  # 並列API呼び出し数
+async def _run_extraction_pipeline(
+    file_entries: list[tuple[str, bytes]], api_key: str, on_complete,
+) -> tuple[dict, dict]:
+    """前処理とAPI呼び出しを非同期にパイプライン実行する
+
+    各ファイルについて「前処理（別スレッド）→ API呼び出し（非同期HTTP）」を
+    1タスクとして走らせる。前処理が済んだファイルから順にAPI呼び出しが始まり、
+    同時リクエスト数はセマフォで MAX_PARALLEL に制限する。スレッドプールと違い
+    タスクごとのスレッドスタックを持たないため、並列数を増やしても軽い。
+
+    Returns: (prepared_map, api_results, prep_errors, dup_sources)
+        prepared_map: fname → (thumbnail, img_b64, mtype)
+        api_results: fname → 抽出結果dict（失敗時None）
+        prep_errors: fname → 前処理の失敗理由（メインスレッドで表示する）
+        dup_sources: fname → 結果を流用した代表ファイル名（UIで明示する）
+    """
+    import anthropic
+
+    prepared_map: dict[str, tuple] = {}
+    api_results: dict[str, Optional[dict]] = {}
+    prep_errors: dict[str, str] = {}
+    dup_sources: dict[str, str] = {}
+    sem = asyncio.Semaphore(MAX_PARALLEL)
+    client = anthropic.AsyncAnthropic(api_key=api_key)
+    # 指紋 → (代表ファイル名, 抽出結果Future)。重複アップロード（同じ書類の
+    # 2回スキャン等）は代表1件だけAPIに送り、残りは結果を待って使い回す。
+    dup_registry: list[tuple[tuple, str, asyncio.Future]] = []
+
+    def _find_duplicate(fp: tuple) -> Optional[tuple[str, asyncio.Future]]:
+        for seen_fp, rep_fname, fut in dup_registry:
+            if _same_document(seen_fp, fp):
+                return rep_fname, fut
+        return None
+
+    async def _process(fname: str, file_bytes: bytes):
+        fname, thumb_src, img_b64, mtype, fp, prep_error = await asyncio.to_thread(
+            _prepare_file, fname, file_bytes
+        )
+        if img_b64 is None:
+            prepared_map[fname] = (thumb_src if isinstance(thumb_src, bytes) else b"", None, None)
+            api_results[fname] = None
+            if prep_error:
+                prep_errors[fname] = prep_error
+        else:
+            # サムネイル生成はAPI応答に不要なので、API待ちの裏で別スレッドに流す
+            thumb_task = asyncio.create_task(asyncio.to_thread(make_thumbnail, thumb_src))
+            # 重複判定と登録はawaitを挟まず行う（イベントループ上で直列なので安全）
+            dup = _find_duplicate(fp) if fp is not None else None
+            if dup is not None:
+                rep_fname, dup_future = dup
+                dup_sources[fname] = rep_fname
+                result = await dup_future
+                # 編集・マージで相互に影響しないようconfidenceごとコピーして持つ
+                api_results[fname] = (
+                    {**result, "confidence": dict(result.get("confidence") or {})}
+                    if result is not None
+                    else None
+                )
+            else:
+                own_future = asyncio.get_running_loop().create_future()
+                if fp is not None:
+                    dup_registry.append((fp, fname, own_future))
+                try:
+                    async with sem:
+                        result = await extract_with_anthropic(client, img_b64, mtype)
+                except BaseException:
+                    own_future.set_result(None)  # 待機中の重複ファイルを解放する
+                    raise
+                api_results[fname] = result
+                own_future.set_result(result)
+            prepared_map[fname] = (await thumb_task, img_b64, mtype)
+        on_complete(fname)
+
+    try:
+        await asyncio.gather(*(_process(fname, data) for fname, data in file_entries))
+    finally:
+        await client.close()
+
+    return prepared_map, api_results, prep_errors, dup_sources
 
 
 def render_extraction_section(uploaded_files: list):
-    """AI抽出のボタンと処理ロジック（並列API呼び出し対応）"""
+    """AI抽出のボタンと処理ロジック（前処理とAPI呼び出しをパイプライン並列化）"""
     st.header("③ AIによるデータ抽出")
 
     if not st.button("すべてのデータを抽出する", type="primary", use_container_width=True):
         return
 
+    api_key = get_secret("ANTHROPIC_API_KEY")
+    if not api_key or api_key.startswith("sk-ant-xxx"):
+        st.error("ANTHROPIC_API_KEYが設定されていません。.envファイルまたはStreamlit Secretsを確認してください。")
+        return
+
     st.session_state["processing"] = True
     inject_beforeunload_guard()
 
@@ -712,28 +1197,14 @@ def render_extraction_section(uploaded_files: list):
     progress = st.progress(0, text=f"抽出中... 0/{total}件 完了")
     start_time = time.time()
 
-    # ── 第1段階: ファイル読み込み・圧縮（メインスレッド、高速） ──
-    prepared = []  # [(fname, image_bytes, image_base64, media_type), ...]
-    for uf in uploaded_files:
-        prepared.append(_prepare_file(uf))
-
-    # ── 第2段階: API呼び出しを並列実行 ──
     all_images = {}
-    api_results: dict[str, Optional[dict]] = {}  # fname → extracted
     completed = 0
-    lock = threading.Lock()
-
-    # 準備成功したもののみAPI呼び出し
-    api_tasks = [(fname, img_b64, mtype)
-                 for fname, _img_bytes, img_b64, mtype in prepared
-                 if img_b64 is not None]
 
     def _on_complete(fname: str):
-        """完了カウント更新（スレッドセーフ）"""
+        """完了カウント更新（イベントループ上で直列に呼ばれる）"""
         nonlocal completed
-        with lock:
-            completed += 1
-            c = completed
+        completed += 1
+        c = completed
 
         elapsed = time.time() - start_time
         if c > 0 and c < total:
@@ -747,30 +1218,25 @@ def render_extraction_section(uploaded_files: list):
             eta = ""
         progress.progress(c / total, text=f"抽出中... {c}/{total}件 完了 {eta}")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL) as executor:
-        futures = {}
-        for fname, img_b64, mtype in api_tasks:
-            future = executor.submit(_call_api, fname, img_b64, mtype)
-            futures[future] = fname
+    # 生バイトはsession_stateのキャッシュから取得（再実行時の読み直しを回避）。
+    # session_stateはメインスレッドからしか触れないため、ここで読み切ってから
+    # パイプラインに渡す。
+    file_entries = [(uf.name, _get_file_bytes(uf)) for uf in uploaded_files]
 
-        for future in concurrent.futures.as_completed(futures):
-            fname, extracted = future.result()
-            api_results[fname] = extracted
-            _on_complete(fname)
+    prepared_map, api_results, prep_errors, dup_sources = asyncio.run(
+        _run_extraction_pipeline(file_entries, api_key, _on_complete)
+    )
 
-    # 準備失敗分もカウント
-    for fname, _img_bytes, img_b64, _mtype in prepared:
-        if img_b64 is None and fname not in api_results:
-            api_results[fname] = None
-            completed += 1
-            progress.progress(
-                min(completed / total, 1.0),
-                text=f"抽出中... {completed}/{total}件 完了",
-            )
+    # 重複扱いでAPIを呼ばなかったファイルは必ず明示する。万一別書類を
+    # 誤って同一と判定していても、レビュー時に気付けるようにするため。
+    for dup_name, rep_name in dup_sources.items():
+        st.info(f"「{dup_name}」は「{rep_name}」と同一書類と判定し、抽出結果を共有しました。内容をご確認ください。")
 
-    # ── 第3段階: 結果を元の順序で組み立て ──
+    # ── 結果を元の順序で組み立て ──
     results = []
-    for fname, image_bytes, _img_b64, _mtype in prepared:
+    for uf in uploaded_files:
+        fname = uf.name
+        image_bytes = prepared_map[fname][0]
         all_images[fname] = image_bytes
         extracted = api_results.get(fname)
 
@@ -779,7 +1245,11 @@ def render_extraction_section(uploaded_files: list):
             extracted["_doc_type"] = extracted.get("書類種別", "不明")
             results.append(extracted)
         else:
-            if not fname.lower().endswith(".pdf"):
+            # 前処理の失敗理由はワーカースレッドでは表示できないため、ここで出す
+            prep_error = prep_errors.get(fname)
+            if prep_error:
+                st.error(f"{fname}: {prep_error}")
+            else:
                 st.warning(f"抽出失敗: {fname}")
             empty = {col: "" for col in CSV_COLUMNS}
             empty["_source_file"] = fname
@@ -812,21 +1282,30 @@ def _get_record_name(data: dict, data_idx: int) -> str:
     return name or f"レコード{data_idx + 1}"
 
 
-def _field_status(col_name: str, value: str, low_fields: list[str]) -> tuple[str, str]:
+# _field_status用の定型ヘルプ文（毎回f-stringを組み立てない）
+_HELP_EMPTY_REQUIRED = "未入力（必須） — 手入力してください"
+_HELP_EMPTY_OPTIONAL = "未入力（任意） — 手入力してください"
+_HELP_LOW_CONF = "AI読取だが不鮮明 — 確認・修正してください"
+_HELP_HIGH_CONF = "AI読取（自信あり）"
+
+
+def _field_status(col_name: str, value: str, low_fields_set: frozenset) -> tuple[str, str]:
     """フィールドの入力ステータスを判定
 
+    low_fields_setはset/frozensetを渡すこと（カラム数×カード数回呼ばれるため）。
+
     Returns: (status_icon, help_text)
         🤖 = AIが自信ありで入力  ⚠️ = AI入力だが不鮮明  ✏️ = 未入力（手入力必要）
     """
     val = value.strip()
     if not val:
-        is_required = col_name in REQUIRED_FIELDS
-        req_label = "（必須）" if is_required else "（任意）"
-        return "✏️", f"未入力{req_label} — 手入力してください"
-    elif col_name in low_fields:
-        return "⚠️", "AI読取だが不鮮明 — 確認・修正してください"
+        if col_name in _REQUIRED_SET:
+            return "✏️", _HELP_EMPTY_REQUIRED
+        return "✏️", _HELP_EMPTY_OPTIONAL
+    elif col_name in low_fields_set:
+        return "⚠️", _HELP_LOW_CONF
     else:
-        return "🤖", "AI読取（自信あり）"
+        return "🤖", _HELP_HIGH_CONF
 
 
 def _render_review_card(
@@ -837,15 +1316,21 @@ def _render_review_card(
     """レビューカード1件を描画（Human In The Loop対応）"""
     name = _get_record_name(data, data_idx)
     source_types = data.get("_source_types", [])
+    low_set = frozenset(low_fields)
 
-    if len(imgs) > 1:
-        type_names = [t for t in source_types if t != "不明"] if source_types else []
-        if type_names:
-            merged_label = f"（{'＋'.join(type_names)} を突合）"
+    # 突合ラベルはソース構成が変わらない限り不変なので、初回計算後は
+    # レコード自体にキャッシュして再実行時の文字列組み立てを省く
+    merged_label = data.get("_merged_label")
+    if merged_label is None:
+        if len(imgs) > 1:
+            type_names = [t for t in source_types if t != "不明"] if source_types else []
+            if type_names:
+                merged_label = f"（{'＋'.join(type_names)} を突合）"
+            else:
+                merged_label = f"（書類{len(imgs)}枚を突合）"
         else:
-            merged_label = f"（書類{len(imgs)}枚を突合）"
-    else:
-        merged_label = ""
+            merged_label = ""
+        data["_merged_label"] = merged_label
 
     # ── ヘッダー ──
     if pct < 60:
@@ -855,10 +1340,21 @@ def _render_review_card(
     else:
         st.success(f"**{name}** — 照合率 {pct}%{merged_label}")
 
-    # ── フィールドサマリー（凡例＋概況） ──
-    n_ai = sum(1 for c in CSV_COLUMNS if str(data.get(c, "")).strip() and c not in low_fields)
-    n_warn = sum(1 for c in CSV_COLUMNS if str(data.get(c, "")).strip() and c in low_fields)
-    n_empty = sum(1 for c in CSV_COLUMNS if not str(data.get(c, "")).strip())
+    # ── フィールド値・ステータス・概況を1パスで集計 ──
+    # （以前は集計3回＋フォーム描画1回で同じ値を4回文字列化していた）
+    n_ai = n_warn = n_empty = 0
+    field_entries = []  # (col_name, val, icon, help_text)
+    for col_name in CSV_COLUMNS:
+        val = str(data.get(col_name, ""))
+        icon, help_text = _field_status(col_name, val, low_set)
+        if icon == "✏️":
+            n_empty += 1
+        elif icon == "⚠️":
+            n_warn += 1
+        else:
+            n_ai += 1
+        field_entries.append((col_name, val, icon, help_text))
+
     st.caption(
         f"🤖 AI入力（自信あり）: {n_ai}件　|　"
         f"⚠️ AI入力（要確認）: {n_warn}件　|　"
@@ -884,14 +1380,13 @@ def _render_review_card(
     # ── フォーム（フィールドごとにステータス表示） ──
     with col_form:
         form_cols = st.columns(3)
-        for fi, col_name in enumerate(CSV_COLUMNS):
+        key_prefix = f"review_{item_idx}_"  # f-string整形はカードごとに1回で済ませる
+        for fi, (col_name, val, icon, help_text) in enumerate(field_entries):
             with form_cols[fi % 3]:
-                val = str(data.get(col_name, ""))
-                icon, help_text = _field_status(col_name, val, low_fields)
                 st.text_input(
                     f"{icon} {col_name}",
                     value=val,
-                    key=f"review_{item_idx}_{col_name}",
+                    key=key_prefix + col_name,
                     help=help_text,
                 )
 
@@ -917,31 +1412,41 @@ def _apply_review_changes(review_items: list, delete_checks: dict, data_list: li
     del_indices = set()
     deleted_files = set()
     confirmed_count = 0
+    # 属性チェーンの解決を1回にする（レコード数×カラム数回の参照があるため）
+    ss_get = st.session_state.get
 
-    for item_idx, (data_idx, _data, imgs, _pct, _lf) in enumerate(review_items):
+    for item_idx, (data_idx, _data, imgs, _pct, low_fields) in enumerate(review_items):
         if delete_checks.get(item_idx):
             del_indices.add(data_idx)
             deleted_files.update(f for f, _ in imgs)
         else:
+            entry = data_list[data_idx]
+            key_prefix = f"review_{item_idx}_"
             for col_name in CSV_COLUMNS:
-                val = st.session_state.get(f"review_{item_idx}_{col_name}", "")
-                data_list[data_idx][col_name] = val
-            if "confidence" in data_list[data_idx]:
-                for col_name in CSV_COLUMNS:
-                    data_list[data_idx]["confidence"][col_name] = "high"
+                entry[col_name] = ss_get(key_prefix + col_name, "")
+            conf = entry.get("confidence")
+            if conf is not None:
+                # 元からhighの項目は触らず、要確認だった項目だけhigh化すれば十分
+                for col_name in low_fields:
+                    conf[col_name] = "high"
             # 確認済みフラグを保存
-            is_confirmed = st.session_state.get(f"confirmed_{item_idx}", False)
-            data_list[data_idx]["_confirmed"] = is_confirmed
+            is_confirmed = ss_get(f"confirmed_{item_idx}", False)
+            entry["_confirmed"] = is_confirmed
             if is_confirmed:
                 confirmed_count += 1
 
+    # session_stateプロキシへの書き込みは1キーあたり1回にまとめる
+    # （popの繰り返しではなくフィルタ済みdictを一括で差し替える）
+    updates = {}
     if del_indices:
-        for idx in sorted(del_indices, reverse=True):
-            data_list.pop(idx)
-        for fn in deleted_files:
-            st.session_state["all_images"].pop(fn, None)
-
-    st.session_state["extracted_data"] = data_list
+        # 逆順popのO(N·K)ではなく、1パスのフィルタで再構築する
+        data_list = [d for i, d in enumerate(data_list) if i not in del_indices]
+        updates["all_images"] = {
+            k: v for k, v in st.session_state["all_images"].items()
+            if k not in deleted_files
+        }
+    updates["extracted_data"] = data_list
+    st.session_state.update(updates)
 
     applied = len(review_items) - len(del_indices)
     msg_parts = []
@@ -963,21 +1468,23 @@ def render_review_section():
 
     review_items = []
     for idx, data in enumerate(data_list):
-        src_files = data.get("_source_files", [data.get("_source_file", "")])
-        matching_imgs = [(f, img_map[f]) for f in src_files if f in img_map]
+        # get(..., default)だとデフォルト側も毎回評価されるため or で遅延させる
+        src_files = data.get("_source_files") or [data.get("_source_file", "")]
+        matching_imgs = [(f, b) for f in src_files if (b := img_map.get(f)) is not None]
         if matching_imgs:
             pct, _label, low_fields = calc_confidence(data)
             review_items.append((idx, data, matching_imgs, pct, low_fields))
 
     if not review_items:
         return
+    review_items = tuple(review_items)  # 以降は読み取り専用
 
-    items_ok = [(ii, di, d, im, p, lf)
-                for ii, (di, d, im, p, lf) in enumerate(review_items)
-                if is_record_ok(p, lf)]
-    items_ng = [(ii, di, d, im, p, lf)
-                for ii, (di, d, im, p, lf) in enumerate(review_items)
-                if not is_record_ok(p, lf)]
+    # OK/要確認への振り分けは1パスで行う（is_record_okを2度呼ばない）
+    items_ok = []
+    items_ng = []
+    for ii, (di, d, im, p, lf) in enumerate(review_items):
+        target = items_ok if is_record_ok(p, lf) else items_ng
+        target.append((ii, di, d, im, p, lf))
 
     # ── セクションヘッダー（「下書き」であることを明示） ──
     st.header("📝 AIの下書き — 確認・修正")
@@ -1001,30 +1508,43 @@ def render_review_section():
         text=f"確認済み: {confirmed_count}/{total_count}件",
     )
 
-    tab_ng, tab_ok = st.tabs([
-        f"⚠️ 要確認（{len(items_ng)}件）",
-        f"✅ OK（{len(items_ok)}件）",
-    ])
-
     delete_checks: dict[int, bool] = {}
 
-    with tab_ng:
-        if items_ng:
-            st.caption("⚠️ 要確認項目があるレコードです。修正・削除後、下部のボタンで一括反映されます。")
-            for item_idx, data_idx, data, imgs, pct, low_fields in items_ng:
-                _render_review_card(item_idx, data_idx, data, imgs, pct, low_fields, delete_checks)
-        else:
-            st.info("要確認レコードはありません。")
+    # フォームで囲むことで、テキスト修正やチェック操作のたびにスクリプト全体が
+    # 再実行されるのを防ぐ（反映ボタン押下時にまとめて送信される）
+    with st.form("review_form"):
+        tab_ng, tab_ok = st.tabs([
+            f"⚠️ 要確認（{len(items_ng)}件）",
+            f"✅ OK（{len(items_ok)}件）",
+        ])
+
+        # 各カードは折りたたみ式にして、開くまで画像や入力欄をブラウザへ送らない
+        # （閉じたexpanderの中身は描画されないため、カード数が多くても軽い）
+        with tab_ng:
+            if items_ng:
+                st.caption("⚠️ 要確認項目があるレコードです。修正・削除後、下部のボタンで一括反映されます。")
+                for item_idx, data_idx, data, imgs, pct, low_fields in items_ng:
+                    label = f"⚠️ {_get_record_name(data, data_idx)} — 照合率 {pct}%"
+                    with st.expander(label, expanded=len(items_ng) == 1):
+                        _render_review_card(item_idx, data_idx, data, imgs, pct, low_fields, delete_checks)
+            else:
+                st.info("要確認レコードはありません。")
+
+        with tab_ok:
+            if items_ok:
+                st.caption("🤖 AI読取の精度が高いレコードです。内容を目視確認して「✅ 内容を確認しました」にチェックしてください。")
+                for item_idx, data_idx, data, imgs, pct, low_fields in items_ok:
+                    label = f"✅ {_get_record_name(data, data_idx)} — 照合率 {pct}%"
+                    with st.expander(label, expanded=len(items_ok) == 1):
+                        _render_review_card(item_idx, data_idx, data, imgs, pct, low_fields, delete_checks)
+            else:
+                st.info("照合率OKのレコードはありません。")
 
-    with tab_ok:
-        if items_ok:
-            st.caption("🤖 AI読取の精度が高いレコードです。内容を目視確認して「✅ 内容を確認しました」にチェックしてください。")
-            for item_idx, data_idx, data, imgs, pct, low_fields in items_ok:
-                _render_review_card(item_idx, data_idx, data, imgs, pct, low_fields, delete_checks)
-        else:
-            st.info("照合率OKのレコードはありません。")
+        submitted = st.form_submit_button(
+            "すべての修正をまとめて反映", type="primary", use_container_width=True,
+        )
 
-    if st.button("すべての修正をまとめて反映", type="primary", use_container_width=True):
+    if submitted:
         _apply_review_changes(review_items, delete_checks, data_list)
 
 
@@ -1042,7 +1562,8 @@ def render_results_section():
     raw_count = st.session_state.get("raw_count", len(data_list))
 
     df, conf_info = build_dataframe(data_list)
-    ok_count = sum(1 for c in conf_info if c["label"] == "OK")
+    # 判定ラベルの集計は構築済みの列に対するベクトル演算で行う
+    ok_count = int((df["判定"] == "OK").sum())
     review_count = len(conf_info) - ok_count
 
     # 確認済みカウント
@@ -1067,32 +1588,35 @@ def render_results_section():
     col1, col2, col3, col4 = st.columns(4)
     col1.metric("✅ 確認済み", f"{total_confirmed}件")
     col2.metric("⚠️ 未確認", f"{total_unconfirmed}件")
-    avg_pct = sum(c["pct"] for c in conf_info) // len(conf_info) if conf_info else 0
+    if conf_info:
+        pcts = np.fromiter((c["pct"] for c in conf_info), dtype=np.int16, count=len(conf_info))
+        avg_pct = int(pcts.mean())
+    else:
+        avg_pct = 0
     col3.metric("平均照合率", f"{avg_pct}%")
     col4.metric("合計", f"{len(data_list)}件")
 
     # フィルタ
     view_filter = st.radio("表示フィルタ", ["すべて", "要確認のみ", "OKのみ"], horizontal=True)
 
-    if view_filter == "要確認のみ":
-        mask = df["判定"] != "OK"
-        display_df = df[mask].reset_index(drop=True)
-        display_conf = [c for c in conf_info if c["label"] != "OK"]
-    elif view_filter == "OKのみ":
-        mask = df["判定"] == "OK"
-        display_df = df[mask].reset_index(drop=True)
-        display_conf = [c for c in conf_info if c["label"] == "OK"]
-    else:
+    if view_filter == "すべて":
         display_df = df
         display_conf = conf_info
+    else:
+        # ベクトル演算のマスクを1回計算し、DataFrameとconf_infoの両方に使い回す
+        mask = (df["判定"] == "OK") if view_filter == "OKのみ" else (df["判定"] != "OK")
+        display_df = df[mask].reset_index(drop=True)
+        display_conf = [c for c, keep in zip(conf_info, mask.tolist()) if keep]
 
     # 要確認項目の詳細
     if display_conf and any(c["low_fields"] for c in display_conf):
         with st.expander("要確認項目の詳細", expanded=review_count > 0):
+            # ilocは1行ごとにSeriesを生成して重いので、列を一度リスト化して添字アクセスする
+            sei_list = display_df["利用者_姓"].tolist()
+            mei_list = display_df["利用者_名"].tolist()
             for i, c in enumerate(display_conf):
                 if c["low_fields"]:
-                    row = display_df.iloc[i]
-                    name = f"{row.get('利用者_姓', '')} {row.get('利用者_名', '')}".strip() or f"行{i + 1}"
+                    name = f"{sei_list[i]} {mei_list[i]}".strip() or f"行{i + 1}"
                     st.markdown(f"**{name}** (照合率 {c['pct']}%) — 不明項目: {', '.join(c['low_fields'])}")
 
     # 編集可能テーブル
@@ -1105,7 +1629,7 @@ def render_results_section():
         key="data_editor",
     )
 
-    export_df = edited_df[CSV_COLUMNS] if all(c in edited_df.columns for c in CSV_COLUMNS) else edited_df
+    export_df = edited_df[list(CSV_COLUMNS)] if all(c in edited_df.columns for c in CSV_COLUMNS) else edited_df
 
     # ⑤ CSVダウンロード
     st.header("⑤ CSVダウンロード")
@@ -1164,6 +1688,8 @@ def main():
     st.title("利用者情報 自動抽出・CSV出力ツール")
     st.caption("障害福祉サービス事業所向け — 受給者証・契約書からのデータ自動抽出プロトタイプ")
 
+    _preload_heavy_modules()
+
     if st.session_state.get("processing"):
         inject_beforeunload_guard()
 